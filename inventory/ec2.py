@@ -158,6 +158,11 @@ import sys
 import os
 import argparse
 import re
+import fcntl
+import hashlib
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 from copy import deepcopy
 from datetime import date, datetime
@@ -194,6 +199,7 @@ DEFAULTS = {
     'aws_security_token': '',
     'boto_profile': '',
     'cache_max_age': '300',
+    'cache_max_stale_age': '0',
     'cache_path': '~/.ansible/tmp',
     'destination_variable': 'public_dns_name',
     'elasticache': 'True',
@@ -223,6 +229,7 @@ DEFAULTS = {
     'hostname_variable': '',
     'iam_role': '',
     'include_rds_clusters': 'False',
+    'max_concurrency': '1',
     'nested_groups': 'False',
     'pattern_exclude': '',
     'pattern_include': '',
@@ -237,6 +244,17 @@ DEFAULTS = {
     'vpc_destination_variable': 'ip_address'
 }
 
+# Settings not changing the inventory, left out of the cache name digest
+CACHE_SETTINGS_EXCLUDE = (
+    'aws_access_key_id',
+    'aws_secret_access_key',
+    'aws_security_token',
+    'cache_max_age',
+    'cache_max_stale_age',
+    'cache_path',
+    'max_concurrency',
+)
+
 
 class Ec2Inventory(object):
 
@@ -279,10 +297,21 @@ class Ec2Inventory(object):
                 self.fail_with_error("boto version must be >= 2.24 to use profile")
 
         # Cache
+        if self.args.revalidate:
+            self.refresh_cache(blocking=False)
+            return
+
         if self.args.refresh_cache:
-            self.do_api_calls_update_cache()
+            self.refresh_cache(force=True)
         elif not self.is_cache_valid():
-            self.do_api_calls_update_cache()
+            # A disabled cache (cache_max_age = 0) is never served stale
+            if self.cache_max_age > 0 and \
+                    self.cache_max_stale_age > self.cache_max_age and \
+                    self.is_cache_valid(self.cache_max_stale_age):
+                # Serve the stale cache and refresh it in the background
+                self.start_background_refresh()
+            else:
+                self.refresh_cache()
 
         # Data to print
         if self.args.host:
@@ -297,18 +326,75 @@ class Ec2Inventory(object):
 
         print(data_to_print)
 
-    def is_cache_valid(self):
+    def is_cache_valid(self, max_age=None):
         ''' Determines if the cache files have expired, or if it is still valid '''
 
+        if max_age is None:
+            max_age = self.cache_max_age
+
         if os.path.isfile(self.cache_path_cache):
             mod_time = os.path.getmtime(self.cache_path_cache)
             current_time = time()
-            if (mod_time + self.cache_max_age) > current_time:
+            if (mod_time + max_age) > current_time:
                 if os.path.isfile(self.cache_path_index):
                     return True
 
         return False
 
+    def refresh_cache(self, force=False, blocking=True):
+        ''' Refreshes the cache holding a lock, so concurrent processes make
+        the API calls once. Processes waiting on the lock use the cache
+        written meanwhile by the lock holder instead of refreshing it again.
+        Without blocking, the refresh is skipped if the lock is held '''
+
+        # A cache that is never reused is not worth serializing refreshes for
+        if self.cache_max_age == 0:
+            self.do_api_calls_update_cache()
+            return
+
+        wait_start = time()
+        with open(self.cache_path_lock, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except (IOError, OSError):
+                if blocking:
+                    raise
+                return
+            try:
+                if self.is_cache_valid() and (
+                        not force or os.path.getmtime(self.cache_path_cache) >= wait_start):
+                    return
+                self.do_api_calls_update_cache()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def is_refresh_running(self):
+        ''' Determines if another process holds the cache refresh lock '''
+
+        with open(self.cache_path_lock, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return True
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return False
+
+    def start_background_refresh(self):
+        ''' Starts a detached process refreshing the cache, unless a refresh
+        is already running '''
+
+        if self.is_refresh_running():
+            return
+
+        command = [sys.executable, os.path.realpath(__file__), '--revalidate']
+        if self.args.boto_profile:
+            command += ['--profile', self.args.boto_profile]
+
+        # The process must not hold the stdout Ansible reads the inventory from
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull,
+                             close_fds=True, preexec_fn=os.setsid)
+
     def read_settings(self):
         ''' Reads the settings from the ec2.ini file '''
 
@@ -400,6 +486,9 @@ class Ec2Inventory(object):
         # Include ElastiCache instances?
         self.elasticache_enabled = config.getboolean('ec2', 'elasticache')
 
+        # Number of regions fetched concurrently
+        self.max_concurrency = max(1, config.getint('ec2', 'max_concurrency'))
+
         # Return all EC2 instances?
         self.all_instances = config.getboolean('ec2', 'all_instances')
 
@@ -458,22 +547,6 @@ class Ec2Inventory(object):
                 if aws_security_token:
                     self.credentials['security_token'] = aws_security_token
 
-        # Cache related
-        cache_dir = os.path.expanduser(config.get('ec2', 'cache_path'))
-        if self.boto_profile:
-            cache_dir = os.path.join(cache_dir, 'profile_' + self.boto_profile)
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir)
-
-        cache_name = 'ansible-ec2'
-        cache_id = self.boto_profile or os.environ.get('AWS_ACCESS_KEY_ID', self.credentials.get('aws_access_key_id'))
-        if cache_id:
-            cache_name = '%s-%s' % (cache_name, cache_id)
-        cache_name += '-' + str(abs(hash(__file__)))[1:7]
-        self.cache_path_cache = os.path.join(cache_dir, "%s.cache" % cache_name)
-        self.cache_path_index = os.path.join(cache_dir, "%s.index" % cache_name)
-        self.cache_max_age = config.getint('ec2', 'cache_max_age')
-
         self.expand_csv_tags = config.getboolean('ec2', 'expand_csv_tags')
 
         # Configure nested groups instead of flat namespace.
@@ -528,6 +601,46 @@ class Ec2Inventory(object):
                     filters[filter_key] = filter_value
                 self.ec2_instance_filters.append(filters.copy())
 
+        # Cache related
+        cache_dir = os.path.expanduser(config.get('ec2', 'cache_path'))
+        if self.boto_profile:
+            cache_dir = os.path.join(cache_dir, 'profile_' + self.boto_profile)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        cache_name = 'ansible-ec2'
+        cache_id = self.boto_profile or os.environ.get('AWS_ACCESS_KEY_ID', self.credentials.get('aws_access_key_id'))
+        if cache_id:
+            cache_name = '%s-%s' % (cache_name, cache_id)
+        cache_name += '-' + self.get_settings_digest(config)
+        self.cache_path_cache = os.path.join(cache_dir, "%s.cache" % cache_name)
+        self.cache_path_index = os.path.join(cache_dir, "%s.index" % cache_name)
+        self.cache_path_lock = os.path.join(cache_dir, "%s.lock" % cache_name)
+        self.cache_path_hostvars = os.path.join(cache_dir, "%s.hostvars" % cache_name)
+        self.cache_max_age = config.getint('ec2', 'cache_max_age')
+        self.cache_max_stale_age = config.getint('ec2', 'cache_max_stale_age')
+
+    def get_settings_digest(self, config):
+        ''' Returns a digest of the effective settings and the script itself,
+        so the same settings share a cache and changed settings invalidate it '''
+
+        settings = {
+            'ec2': dict(
+                (key, value) for key, value in config.items('ec2', raw=True)
+                if key not in CACHE_SETTINGS_EXCLUDE
+            ),
+            'regions': self.regions,
+            'instance_filters': self.ec2_instance_filters,
+            'boto_profile': self.boto_profile,
+            'iam_role': self.iam_role,
+        }
+
+        digest = hashlib.sha256()
+        digest.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        with open(os.path.realpath(__file__), 'rb') as f:
+            digest.update(f.read())
+        return digest.hexdigest()[:16]
+
     def parse_cli_args(self):
         ''' Command line argument processing '''
 
@@ -540,6 +653,8 @@ class Ec2Inventory(object):
                             help='Force refresh of cache by making API requests to EC2 (default: False - use cache files)')
         parser.add_argument('--profile', '--boto-profile', action='store', dest='boto_profile',
                             help='Use boto profile for connections to EC2')
+        parser.add_argument('--revalidate', action='store_true', default=False,
+                            help=argparse.SUPPRESS)
         self.args = parser.parse_args()
 
     def do_api_calls_update_cache(self):
@@ -548,18 +663,23 @@ class Ec2Inventory(object):
         if self.route53_enabled:
             self.get_route53_records()
 
-        for region in self.regions:
-            self.get_instances_by_region(region)
-            if self.rds_enabled:
-                self.get_rds_instances_by_region(region)
-            if self.elasticache_enabled:
-                self.get_elasticache_clusters_by_region(region)
-                self.get_elasticache_replication_groups_by_region(region)
-            if self.include_rds_clusters:
-                self.include_rds_clusters_by_region(region)
+        # Regions are fetched concurrently, but added to the inventory in
+        # region order, so the result is the same as fetching them serially
+        workers = min(self.max_concurrency, len(self.regions))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                regions_data = list(executor.map(self.fetch_region, self.regions))
+        else:
+            regions_data = (self.fetch_region(region) for region in self.regions)
 
-        self.write_to_cache(self.inventory, self.cache_path_cache)
+        for region, region_data in zip(self.regions, regions_data):
+            self.add_region(region, region_data)
+
+        # Hostvars and index are written first, so a fresh cache file always has them
+        hostvars_data = self.get_hostvars_data()
+        self.write_data_to_cache(hostvars_data, self.cache_path_hostvars)
         self.write_to_cache(self.index, self.cache_path_index)
+        self.write_to_cache(self.inventory, self.cache_path_cache)
 
     def connect(self, region):
         ''' create connection to api server'''
@@ -600,10 +720,52 @@ class Ec2Inventory(object):
             self.fail_with_error("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
         return conn
 
+    def fetch_region(self, region):
+        ''' Makes all API calls for a region without changing the inventory '''
+
+        region_data = {'instances': self.fetch_instances_by_region(region)}
+        if self.rds_enabled:
+            region_data['rds_instances'] = self.fetch_rds_instances_by_region(region)
+        if self.elasticache_enabled:
+            region_data['elasticache_clusters'] = self.fetch_elasticache_clusters_by_region(region)
+            region_data['elasticache_replication_groups'] = \
+                self.fetch_elasticache_replication_groups_by_region(region)
+        if self.include_rds_clusters:
+            region_data['rds_clusters'] = self.fetch_rds_clusters_by_region(region)
+        return region_data
+
+    def add_region(self, region, region_data):
+        ''' Adds results of fetch_region to the inventory and index '''
+
+        self.add_instances(region_data['instances'], region)
+        for instance in region_data.get('rds_instances', []):
+            self.add_rds_instance(instance, region)
+        for cluster in region_data.get('elasticache_clusters', []):
+            self.add_elasticache_cluster(cluster, region)
+        for replication_group in region_data.get('elasticache_replication_groups', []):
+            self.add_elasticache_replication_group(replication_group, region)
+        if 'rds_clusters' in region_data:
+            self.inventory['db_clusters'] = region_data['rds_clusters']
+
     def get_instances_by_region(self, region):
         ''' Makes an AWS EC2 API call to the list of instances in a particular
         region '''
 
+        self.add_instances(self.fetch_instances_by_region(region), region)
+
+    def add_instances(self, reservations, region):
+        ''' Adds instances of reservations in a particular region '''
+
+        if (not self.aws_account_id) and reservations:
+            self.aws_account_id = reservations[0].owner_id
+
+        for reservation in reservations:
+            for instance in reservation.instances:
+                self.add_instance(instance, region)
+
+    def fetch_instances_by_region(self, region):
+        ''' Returns reservations in a particular region with instance tags '''
+
         try:
             conn = self.connect(region)
             reservations = []
@@ -635,13 +797,11 @@ class Ec2Inventory(object):
             for tag in tags:
                 tags_by_instance_id[tag.res_id][tag.name] = tag.value
 
-            if (not self.aws_account_id) and reservations:
-                self.aws_account_id = reservations[0].owner_id
-
             for reservation in reservations:
                 for instance in reservation.instances:
                     instance.tags = tags_by_instance_id[instance.id]
-                    self.add_instance(instance, region)
+
+            return reservations
 
         except boto.exception.BotoServerError as e:
             if e.error_code == 'AuthFailure':
@@ -682,12 +842,19 @@ class Ec2Inventory(object):
         ''' Makes an AWS API call to the list of RDS instances in a particular
         region '''
 
+        for instance in self.fetch_rds_instances_by_region(region):
+            self.add_rds_instance(instance, region)
+
+    def fetch_rds_instances_by_region(self, region):
+        ''' Returns RDS instances in a particular region matching filters '''
+
         if not HAS_BOTO3:
             self.fail_with_error("Working with RDS instances requires boto3 - please install boto3 and try again",
                                  "getting RDS instances")
 
         client = ec2_utils.boto3_inventory_conn('client', 'rds', region, **self.credentials)
         db_instances = client.describe_db_instances()
+        rds_instances = []
 
         try:
             conn = self.connect_to_aws(rds, region)
@@ -704,7 +871,7 @@ class Ec2Inventory(object):
                         for tag in tags:
                             instance.tags[tag['Key']] = tag['Value']
                         if self.tags_match_filters(instance.tags):
-                            self.add_rds_instance(instance, region)
+                            rds_instances.append(instance)
                     if not marker:
                         break
         except boto.exception.BotoServerError as e:
@@ -720,7 +887,14 @@ class Ec2Inventory(object):
                 error = "Looks like AWS RDS is down:\n%s" % e.message
             self.fail_with_error(error, 'getting RDS instances')
 
+        return rds_instances
+
     def include_rds_clusters_by_region(self, region):
+        self.inventory['db_clusters'] = self.fetch_rds_clusters_by_region(region)
+
+    def fetch_rds_clusters_by_region(self, region):
+        ''' Returns RDS clusters in a particular region by identifier '''
+
         if not HAS_BOTO3:
             self.fail_with_error("Working with RDS clusters requires boto3 - please install boto3 and try again",
                                  "getting RDS clusters")
@@ -774,12 +948,18 @@ class Ec2Inventory(object):
             elif matches_filter:
                 c_dict[c['DBClusterIdentifier']] = c
 
-        self.inventory['db_clusters'] = c_dict
+        return c_dict
 
     def get_elasticache_clusters_by_region(self, region):
         ''' Makes an AWS API call to the list of ElastiCache clusters (with
         nodes' info) in a particular region.'''
 
+        for cluster in self.fetch_elasticache_clusters_by_region(region):
+            self.add_elasticache_cluster(cluster, region)
+
+    def fetch_elasticache_clusters_by_region(self, region):
+        ''' Returns ElastiCache clusters in a particular region '''
+
         # ElastiCache boto module doesn't provide a get_all_instances method,
         # that's why we need to call describe directly (it would be called by
         # the shorthand method anyway...)
@@ -816,13 +996,18 @@ class Ec2Inventory(object):
                 error = "Looks like AWS ElastiCache is down:\n%s" % e.message
             self.fail_with_error(error, 'getting ElastiCache clusters')
 
-        for cluster in clusters:
-            self.add_elasticache_cluster(cluster, region)
+        return clusters
 
     def get_elasticache_replication_groups_by_region(self, region):
         ''' Makes an AWS API call to the list of ElastiCache replication groups
         in a particular region.'''
 
+        for replication_group in self.fetch_elasticache_replication_groups_by_region(region):
+            self.add_elasticache_replication_group(replication_group, region)
+
+    def fetch_elasticache_replication_groups_by_region(self, region):
+        ''' Returns ElastiCache replication groups in a particular region '''
+
         # ElastiCache boto module doesn't provide a get_all_instances method,
         # that's why we need to call describe directly (it would be called by
         # the shorthand method anyway...)
@@ -850,8 +1035,7 @@ class Ec2Inventory(object):
             error = "ElastiCache [Replication Groups] query to AWS failed (unexpected format)."
             self.fail_with_error(error, 'getting ElastiCache clusters')
 
-        for replication_group in replication_groups:
-            self.add_elasticache_replication_group(replication_group, region)
+        return replication_groups
 
     def get_auth_error_message(self):
         ''' create an informative error message if there is an issue authenticating'''
@@ -1636,16 +1820,61 @@ class Ec2Inventory(object):
 
         if self.args.host not in self.index:
             # try updating the cache
-            self.do_api_calls_update_cache()
+            self.refresh_cache(force=True)
+            self.load_index_from_cache()
             if self.args.host not in self.index:
                 # host might not exist anymore
                 return self.json_format_dict({}, True)
 
-        (region, instance_id) = self.index[self.args.host]
+        if not self.args.refresh_cache:
+            host_info = self.get_host_info_from_cache(self.args.host)
+            if host_info is not None:
+                return self.json_format_dict(host_info, True)
+
+        (region, instance_id) = self.index[self.args.host][:2]
 
         instance = self.get_instance(region, instance_id)
         return self.json_format_dict(self.get_host_info_dict_from_instance(instance), True)
 
+    def get_host_info_from_cache(self, host):
+        ''' Reads the variables of a host from the hostvars cache file at the
+        offset kept in the index, without loading the whole inventory '''
+
+        entry = self.index.get(host, [])
+        if len(entry) < 4:
+            return None
+
+        offset, length = entry[2:4]
+        try:
+            with open(self.cache_path_hostvars, 'rb') as f:
+                f.seek(offset)
+                cached_host, host_info = json.loads(f.read(length).decode('utf-8'))
+        except (IOError, OSError, TypeError, ValueError):
+            return None
+
+        # Hostvars file may have been replaced since the index was read
+        if cached_host != host:
+            return None
+
+        return host_info
+
+    def get_hostvars_data(self):
+        ''' Returns inventory hostvars as JSON lines of [host, hostvars] and
+        adds the offset and length of every line to the host index entry '''
+
+        hostvars = self.inventory["_meta"]["hostvars"]
+        lines = []
+        offset = 0
+        for host in sorted(hostvars):
+            line = (json.dumps([host, hostvars[host]], sort_keys=True,
+                               default=self._json_serial) + '\n').encode('utf-8')
+            if host in self.index:
+                self.index[host] = list(self.index[host][:2]) + [offset, len(line)]
+            lines.append(line)
+            offset += len(line)
+
+        return b''.join(lines)
+
     def push(self, my_dict, key, element):
         ''' Push an element onto an array that may not have been defined in
         the dict '''
@@ -1682,9 +1911,25 @@ class Ec2Inventory(object):
     def write_to_cache(self, data, filename):
         ''' Writes data in JSON format to a file '''
 
-        json_data = self.json_format_dict(data, True)
-        with open(filename, 'w') as f:
-            f.write(json_data)
+        self.write_data_to_cache(self.json_format_dict(data, True).encode('utf-8'), filename)
+
+    def write_data_to_cache(self, data, filename):
+        ''' Writes bytes to a cache file. Data is written to a temporary file
+        renamed over the cache file, so readers never see a partially
+        written file '''
+
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # Keep the permissions open(filename, 'w') would create
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_filename, 0o666 & ~umask)
+            os.rename(tmp_filename, filename)
+        except Exception:
+            os.unlink(tmp_filename)
+            raise
 
     def uncammelize(self, key):
         temp = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', key)
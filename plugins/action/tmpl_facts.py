@@ -0,0 +1,140 @@
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+)
+
+__metaclass__ = type
+
+from ansible import constants as C
+from ansible.errors import AnsibleActionFail
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+from ansible.utils.vars import isidentifier
+
+EXAMPLES = """
+- name: load configs from files and template
+  tmpl_facts:
+    vpc_conf:
+    - "{{ vpc_conf_path }}"
+    - "{{ vpc_scrt_path }}"
+    service_conf:
+      terms:
+      - "{{ service_conf_path }}"
+      - "{{ service_scrt_path }}"
+      - "{{ target }}"
+      mode: tree
+
+- name: render template with the loaded service_conf as overlay config
+  tmpl_facts:
+    service_conf:
+      terms:
+      - "{{ service_tmpl_path }}"
+      - "{{ target }}"
+      overlay: "{{ service_conf.template.overlay | d([]) }}"
+      overlay_conf_var: service_conf
+"""
+
+
+class ActionModule(ActionBase):
+    """ Sets tmpl_files lookup results as facts without string templating.
+
+    Every task argument is a fact name with a List of tmpl_files lookup
+    terms or a Dict of 'terms' and lookup options. Lookup result Dicts are
+    set as facts directly, so they are never rendered to text and parsed
+    back by Jinja. Without jinja2_native, a set_fact value, even a single
+    "{{ lookup(...) }}" expression, is rendered to text and evaluated back.
+    Option 'overlay_conf_var' names the variable used as lookup overlay_conf,
+    which is read from task vars for the same reason.
+
+    Unlike set_fact, results are host facts: they have fact precedence, so
+    play vars win over them; they are top level variables only while
+    INJECT_FACTS_AS_VARS is enabled; and every task deep copies them with
+    the other host facts. A persistent fact cache would save them with
+    decrypted secrets, so with any fact cache plugin but 'memory' the task
+    fails unless argument 'cacheable' is true.
+    """
+
+    TRANSFERS_FILES = False
+
+    @staticmethod
+    def _get_terms_and_options(fact_name, fact_args):
+        if isinstance(fact_args, dict):
+            options = dict(fact_args)
+            terms = options.pop('terms', None)
+        else:
+            options = {}
+            terms = fact_args
+
+        if not isinstance(terms, list) or not terms:
+            raise AnsibleActionFail(
+                "Expects a non empty List of lookup terms for fact {}: {!r}".format(
+                    fact_name,
+                    terms
+                )
+            )
+
+        return (terms, options)
+
+    @staticmethod
+    def _get_overlay_conf(fact_name, var_name, task_vars):
+        if var_name not in task_vars:
+            raise AnsibleActionFail(
+                "Undefined overlay_conf_var {} for fact {}".format(
+                    var_name,
+                    fact_name
+                )
+            )
+
+        return task_vars[var_name]
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+
+        args = dict(self._task.args)
+        cacheable = boolean(args.pop('cacheable', False), strict=False)
+
+        if C.CACHE_PLUGIN != 'memory' and not cacheable:
+            raise AnsibleActionFail(
+                (
+                    "Facts would be saved to the '{}' fact cache with any"
+                    " decrypted secrets; set cacheable: true to allow it"
+                ).format(C.CACHE_PLUGIN)
+            )
+
+        lookup = self._shared_loader_obj.lookup_loader.get(
+            'tmpl_files',
+            loader=self._loader,
+            templar=self._templar
+        )
+        facts = {}
+
+        for fact_name, fact_args in args.items():
+            if not isidentifier(fact_name):
+                raise AnsibleActionFail(
+                    "Not a valid variable name: {}".format(fact_name)
+                )
+
+            terms, options = self._get_terms_and_options(fact_name, fact_args)
+            overlay_conf_var = options.pop('overlay_conf_var', None)
+
+            if overlay_conf_var is not None:
+                options['overlay_conf'] = self._get_overlay_conf(
+                    fact_name,
+                    overlay_conf_var,
+                    task_vars
+                )
+
+            values = lookup.run(terms, variables=task_vars, **options)
+
+            # A List of templates renders a List of Dicts.
+            if isinstance(terms[0], list):
+                facts[fact_name] = values
+            else:
+                facts[fact_name] = values[0]
+
+        result['changed'] = False
+        result['ansible_facts'] = facts
+
+        return result
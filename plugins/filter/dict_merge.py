@@ -0,0 +1,96 @@
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+)
+
+__metaclass__ = type
+
+import os
+import importlib.util
+from ansible.errors import AnsibleFilterError
+
+SHARED_INIT_PATH = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    '..',
+    'shared',
+    '__init__.py',
+)
+
+
+def _load_shared():
+    # Merge semantics are shared with tmpl_files overlay composition.
+    spec = importlib.util.spec_from_file_location(
+        'tmpl_files_shared',
+        SHARED_INIT_PATH
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+DictCompose = _load_shared().load('dict_compose').DictCompose
+
+
+def _check_dicts(filter_name, dicts):
+    for d in dicts:
+        if not isinstance(d, dict):
+            raise AnsibleFilterError(
+                "{} expects Dicts, got {!r}".format(filter_name, type(d).__name__)
+            )
+
+
+def deep_merge(x, *ys):
+    """ Recursively merges Dicts ys on to Dict x in order.
+
+    Same result as x | combine(*ys, recursive=True), but only Dicts on
+    changed paths are copied.
+    """
+    _check_dicts('deep_merge', (x,) + ys)
+
+    for y in ys:
+        x = DictCompose.merge(x, y)
+
+    return x
+
+
+def merge_all(dicts):
+    """ Recursively merges a List of Dicts in one pass. """
+    if not isinstance(dicts, list):
+        raise AnsibleFilterError(
+            "merge_all expects a List of Dicts, got {!r}".format(
+                type(dicts).__name__
+            )
+        )
+
+    if not dicts:
+        return {}
+
+    return deep_merge(*dicts)
+
+
+def inflate(item):
+    """ Turns dotted path overlay item in to nested Dict skeleton. """
+    try:
+        return DictCompose.inflate(item)
+    except ValueError as e:
+        raise AnsibleFilterError(e)
+
+
+def template(skeleton, template=None, overlay=None):
+    """ Fills skeleton leaves from overlay, falling back to template. """
+    _check_dicts('template', (skeleton,))
+
+    return DictCompose.fill(skeleton, template or {}, overlay or {})
+
+
+class FilterModule(object):
+    """ Dict merge filters. """
+
+    def filters(self):
+        return {
+            'deep_merge': deep_merge,
+            'merge_all': merge_all,
+            'inflate': inflate,
+            'template': template,
+        }
@@ -6,13 +6,33 @@ from __future__ import (
 
 __metaclass__ = type
 
+import io
 import os
 import re
 import json
+import stat
+import base64
+import pickle
+import socket
+import struct
+import socketserver
+import tempfile
+import threading
+import time
 import yaml
+import importlib.util
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from hashlib import sha256
 from yaml import YAMLError
 from ansible.errors import AnsibleError
-from ansible.parsing.vault import VaultLib, VaultSecret
+from ansible.parsing.vault import (
+    VaultAES256,
+    VaultLib,
+    VaultSecret,
+    parse_vaulttext_envelope,
+)
 from ansible.plugins.lookup import LookupBase
 from ansible.utils.display import Display
 
@@ -32,14 +52,109 @@ DOCUMENTATION = """
             description: >
                 First String with path to file containing templated values and
                 subsequent Strings with path to file or Dicts with values to substitute.
+                First term may be a List of template paths rendered in one batch;
+                every source is then loaded and decrypted once for all templates.
             required: True
         vault_pass:
             description: >
                 Ansible vault password. If not passed, password will be fetched from
                 ENVIRONMENT variable ANSIBLE_VAULT_PASSWORD.
             required: False
+        mode:
+            description: >
+                Templating mode. C(json) serializes the template to JSON and
+                substitutes placeholders in text. C(tree) walks the Dict and
+                rewrites only the string values and keys containing
+                placeholders, sharing untouched subtrees with the source.
+            default: json
+            choices: ['json', 'tree']
+            required: False
+        subtree:
+            description: >
+                Build only the Dict under the dict path of every source file
+                instead of the whole document. Sibling YAML events are skipped
+                while streaming; files with anchors, aliases or merge keys
+                crossing the dict path are fully loaded instead.
+            default: False
+            type: bool
+            required: False
+        parallel:
+            description: >
+                Load and decrypt all String sources concurrently in a thread
+                pool before templating. C(True) uses up to 4 threads, an Int
+                sets the pool size. Sources are still applied in order and
+                templating stops once all placeholders are substituted.
+            default: False
+            required: False
+        overlay:
+            description: >
+                List of overlay items applied on top of the rendered Dict in
+                one pass. Item is a dotted path String, a Dict of dotted paths
+                to values or a List of them. Dotted paths without a value take
+                it from C(overlay_conf), falling back to the rendered Dict.
+                Items are merged in order like Ansible combine(recursive=True).
+            required: False
+        overlay_conf:
+            description: Dict overlay values are taken from.
+            default: {}
+            required: False
+        strict:
+            description: >
+                Fail if any placeholder is left unresolved after all sources,
+                listing every placeholder with its dict path.
+            default: False
+            type: bool
+            required: False
+        strict_ignore:
+            description: >
+                List of dict paths, e.g. C(template.vars), whose placeholders
+                are not reported in strict mode, as they are resolved by a
+                later lookup.
+            default: []
+            required: False
+        chained:
+            description: >
+                Resolve placeholders found in values of sources, e.g. in a
+                public Dict referencing secrets, regardless of source order.
+                Each variable is taken from the first source defining it and
+                values are resolved in dependency order once per lookup.
+                Placeholder cycles fail the lookup. By default every source
+                is applied in order and placeholders brought in by a
+                substituted value are resolved only by subsequent sources.
+            default: False
+            type: bool
+            required: False
     notes:
         - Plugin is useful for vault secrets injection in to configuration file.
+        - Parsed source files are kept pickled in a process-wide LRU cache
+          validated by file inode, mtime and size. Cache limits are set with
+          ENVIRONMENT variables TMPL_FILES_CACHE_MAX_ENTRIES and
+          TMPL_FILES_CACHE_MAX_BYTES (pickled bytes; 0 disables the cache).
+          Ansible forks a worker per task, so the cache only serves repeated
+          loads within one task; use the cache server to share sources
+          between tasks.
+        - Vault keys derived from a password and file salt are cached for the
+          lifetime of the process, so every vault file is key-derived once.
+          The cache is only used on Ansible releases that do not memoize key
+          derivation themselves (stable-2.9).
+        - Sources under market/<market>/<config|secret|template>/<env>/ are
+          read from a snapshot compiled by 'utilities/tmpl-files compile' when
+          all snapshot source hashes match the files on disk. Snapshots are
+          stored in tmp/snapshots or in ENVIRONMENT variable
+          TMPL_FILES_SNAPSHOT_DIR.
+        - Parsed sources can be shared between concurrent Ansible runs by a
+          cache server started with 'utilities/tmpl-files serve'. Lookups
+          query the server on the Unix socket in ENVIRONMENT variable
+          TMPL_FILES_CACHE_SOCKET before reading files and fall back to
+          reading files if it is unavailable. Server and socket must belong
+          to the same user.
+        - Lookups can record wall time of their phases (path resolution, file
+          read, vault detection, decryption, YAML parse, dict path walk, apply
+          passes and final loads) with byte and placeholder counts. The record
+          is displayed at verbosity set by ENVIRONMENT variable
+          TMPL_FILES_TIMINGS_VERBOSITY (default 4) and appended as a JSON line
+          to the file in ENVIRONMENT variable TMPL_FILES_TIMINGS_FILE if set.
+          Below that verbosity and without a timings file nothing is recorded.
 """
 
 EXAMPLES = """
@@ -52,32 +167,1106 @@ EXAMPLES = """
         public_dict
     )
   }}"
+
+- debug: msg="{{
+    lookup(
+        'tmpl_files',
+        template_file_path,
+        secret_file_path,
+        mode='tree'
+    )
+  }}"
+
+- debug: msg="{{
+    query(
+        'tmpl_files',
+        [template_file_path, other_template_file_path],
+        secret_file_path,
+        public_dict
+    )
+  }}"
 """
 
 RETURN = """
 description:
     - Dict from the first passed file:dict string with performed templating substitutions.
+    - List of Dicts in template order if the first term is a List.
 """
 
 # Global variables
 VAULT_FILE_LINE = '$ANSIBLE_VAULT;'
 VAULT_PASS_ENV_VAR = 'ANSIBLE_VAULT_PASSWORD'
 
+SECRET_KIND = '!'
+PUBLIC_KIND = '?'
+# Matches pattern: "{! var-name !}" or {! var-name !} and the same for "?".
+JSON_PATTERN = re.compile(r'"?{([!?])([- \w]*)\1}"?')
+# Same pattern matched against raw strings in tree mode.
+TREE_PATTERN = re.compile(r'{([!?])([- \w]*)\1}')
+TMPL_MODES = ('json', 'tree')
+# libyaml backed loader is several times faster and is used when PyYAML is
+# built with it. Both loaders share FullConstructor, so results are the same.
+YAML_LOADER = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+CACHE_MAX_ENTRIES_ENV_VAR = 'TMPL_FILES_CACHE_MAX_ENTRIES'
+CACHE_MAX_BYTES_ENV_VAR = 'TMPL_FILES_CACHE_MAX_BYTES'
+CACHE_MAX_ENTRIES = 128
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+SNAPSHOT_DIR_ENV_VAR = 'TMPL_FILES_SNAPSHOT_DIR'
+TIMINGS_VERBOSITY_ENV_VAR = 'TMPL_FILES_TIMINGS_VERBOSITY'
+TIMINGS_FILE_ENV_VAR = 'TMPL_FILES_TIMINGS_FILE'
+TIMINGS_VERBOSITY = 4
+PARALLEL_MAX_WORKERS = 4
+MARKET_ROOT = os.path.realpath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..')
+)
+SHARED_INIT_PATH = os.path.join(
+    MARKET_ROOT,
+    'plugins',
+    'shared',
+    '__init__.py',
+)
+CACHE_SOCKET_ENV_VAR = 'TMPL_FILES_CACHE_SOCKET'
+CACHE_SERVER_TTL = 300
+CACHE_CLIENT_TIMEOUT = 10
+# Socket messages are prefixed with payload length.
+MESSAGE_HEADER = struct.Struct('!I')
+SNAPSHOT_VERSION = 1
+
+
+def _get_env_int(name, default):
+    value = os.environ.get(name)
+
+    if value is None:
+        return default
+
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(
+            "The {} variable must be an Int: {!r}".format(name, value)
+        )
+
+
+def _load_shared():
+    # Shared modules are not plugins; plugins/shared loads them by name.
+    spec = importlib.util.spec_from_file_location(
+        'tmpl_files_shared',
+        SHARED_INIT_PATH
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+shared = _load_shared()
+DictCompose = shared.load('dict_compose').DictCompose
+market_index = shared.load('market_index')
+# Snapshots cover the same market sources the infra-vars index does.
+SNAPSHOT_KINDS = market_index.SOURCE_KINDS
+SNAPSHOT_SOURCE_PATTERN = market_index.SOURCE_PATTERN
+
+
+class Timings:
+    """ Wall time and counters of lookup phases, in total and per source.
+
+    Disabled Timings record nothing and report nothing, so lookups whose
+    record would be neither displayed nor written skip the bookkeeping.
+    """
+
+    def __init__(self, enabled=True, verbosity=TIMINGS_VERBOSITY):
+        self.enabled = enabled
+        self.verbosity = verbosity
+        self.start = time.time()
+        self.phases = OrderedDict()
+        self.counts = OrderedDict()
+        self.sources = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "Timings: {!r}".format(self.as_dict())
+
+    def _get_source(self, source):
+        return self.sources.setdefault(
+            source,
+            {'phases': OrderedDict(), 'counts': OrderedDict()}
+        )
+
+    @staticmethod
+    def _add_phase(phases, name, seconds):
+        phase = phases.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        phase['seconds'] += seconds
+        phase['calls'] += 1
+
+    @staticmethod
+    def _add_count(counts, name, n):
+        counts[name] = counts.get(name, 0) + n
+
+    @classmethod
+    def from_env(cls):
+        """ Returns Timings enabled if verbosity or timings file wants them. """
+        verbosity = _get_env_int(TIMINGS_VERBOSITY_ENV_VAR, TIMINGS_VERBOSITY)
+
+        return cls(
+            enabled=(
+                display.verbosity >= verbosity
+                or bool(os.environ.get(TIMINGS_FILE_ENV_VAR))
+            ),
+            verbosity=verbosity
+        )
+
+    def add(self, name, seconds, source=None):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._add_phase(self.phases, name, seconds)
+
+            if source is not None:
+                self._add_phase(self._get_source(source)['phases'], name, seconds)
+
+    def count(self, name, n=1, source=None):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._add_count(self.counts, name, n)
+
+            if source is not None:
+                self._add_count(self._get_source(source)['counts'], name, n)
+
+    @contextmanager
+    def phase(self, name, source=None):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, source)
+
+    def as_dict(self, **fields):
+        record = OrderedDict(fields)
+        record['start'] = self.start
+        record['seconds'] = time.time() - self.start
+        record['phases'] = self.phases
+        record['counts'] = self.counts
+        record['sources'] = self.sources
+
+        return record
+
+    def report(self, **fields):
+        if not self.enabled:
+            return
+
+        record = json.dumps(self.as_dict(pid=os.getpid(), **fields))
+        display.verbose(
+            "tmpl_files timings: {}".format(record),
+            caplevel=self.verbosity - 1
+        )
+
+        timings_file = os.environ.get(TIMINGS_FILE_ENV_VAR)
+
+        if not timings_file:
+            return
+
+        # Single O_APPEND write keeps lines from concurrent forks whole.
+        try:
+            fd = os.open(
+                timings_file,
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0o644
+            )
+            try:
+                os.write(fd, (record + '\n').encode())
+            finally:
+                os.close(fd)
+        except (IOError, OSError) as e:
+            display.warning(
+                "Error writing tmpl_files timings to {}: {!s}".format(
+                    timings_file,
+                    e
+                )
+            )
+
+
+class SourceCache:
+    """ Process-wide LRU cache of parsed source files.
+
+    Entries are keyed by real file path and validated against the file
+    (inode, mtime, size) signature, so a changed file is never served stale.
+    Parsed sources are stored pickled: every hit unpickles a private copy,
+    so lookup results never share objects with the cache, and memory is
+    bounded by entry count and by the sum of pickled entry sizes.
+
+    Ansible runs lookups in a worker process forked per task, so entries
+    are only reused within one task (loops, batch templates, sources used
+    by several terms). The cache server or snapshots share sources across
+    tasks.
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "SourceCache: {!r}".format(self.stats())
+
+    @staticmethod
+    def get_key(file_path):
+        real_path = os.path.realpath(file_path)
+        st = os.stat(real_path)
+
+        return (real_path, (st.st_ino, st.st_mtime_ns, st.st_size))
+
+    def get(self, key):
+        real_path, signature = key
+
+        with self._lock:
+            entry = self._entries.get(real_path)
+
+            if entry is None or entry[0] != signature:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(real_path)
+            self.hits += 1
+            data = entry[1]
+
+        return pickle.loads(data)
+
+    def put(self, key, value):
+        real_path, signature = key
+
+        if self.max_entries < 1:
+            return
+
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        if len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            old_entry = self._entries.pop(real_path, None)
+            if old_entry is not None:
+                self.size -= len(old_entry[1])
+
+            self._entries[real_path] = (signature, data)
+            self.size += len(data)
+
+            while (
+                len(self._entries) > self.max_entries
+                or self.size > self.max_bytes
+            ):
+                _, (_, old_data) = self._entries.popitem(last=False)
+                self.size -= len(old_data)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+SOURCE_CACHE = SourceCache(
+    max_entries=_get_env_int(CACHE_MAX_ENTRIES_ENV_VAR, CACHE_MAX_ENTRIES),
+    max_bytes=_get_env_int(CACHE_MAX_BYTES_ENV_VAR, CACHE_MAX_BYTES),
+)
+
+
+class VaultKeyCache:
+    """ PBKDF2 derived vault keys keyed by (password fingerprint, salt). """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, b_password, b_salt):
+        key = (sha256(b_password).digest(), b_salt)
+
+        with self._lock:
+            derived = self._keys.get(key)
+
+            if derived is not None:
+                self.hits += 1
+                return derived
+
+            self.misses += 1
+
+        derived = VaultAES256._gen_key_initctr(b_password, b_salt)
+
+        with self._lock:
+            self._keys[key] = derived
+
+        return derived
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+VAULT_KEY_CACHE = VaultKeyCache()
+# Newer Ansible caches _gen_key_initctr itself, a second cache buys nothing.
+VAULT_KEY_CACHE_ENABLED = getattr(
+    VaultAES256._gen_key_initctr,
+    'cache_clear',
+    None
+) is None
+
+
+class _CachedVaultAES256(VaultAES256):
+    """ VaultAES256 cipher deriving keys through VAULT_KEY_CACHE. """
+
+    @classmethod
+    def _gen_key_initctr(cls, b_password, b_salt):
+        return VAULT_KEY_CACHE.get(b_password, b_salt)
+
+
+class VaultDecryptor:
+    """ Vault decryptor shared by all DictPath objects using one password. """
+
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, vault_pass):
+        self.secret = VaultSecret(vault_pass)
+        self.cipher = (
+            _CachedVaultAES256() if VAULT_KEY_CACHE_ENABLED else VaultAES256()
+        )
+
+    @classmethod
+    def get(cls, vault_pass):
+        fingerprint = sha256(vault_pass).digest()
+
+        with cls._lock:
+            decryptor = cls._instances.get(fingerprint)
+
+            if decryptor is None:
+                decryptor = cls._instances[fingerprint] = cls(vault_pass)
+
+        return decryptor
+
+    def decrypt(self, b_vaulttext_envelope):
+        b_vaulttext, _, cipher_name, _ = parse_vaulttext_envelope(
+            b_vaulttext_envelope
+        )
+
+        if cipher_name != 'AES256':
+            raise AnsibleError(
+                "Unsupported vault cipher: {!s}".format(cipher_name)
+            )
+
+        return self.cipher.decrypt(b_vaulttext, self.secret)
+
+
+class SafeUnpickler(pickle.Unpickler):
+    """ Unpickler of parsed YAML data refusing any other class.
+
+    Snapshots and cache server responses hold only what the YAML loader
+    constructs, so pickles referencing anything else (and with it any code
+    execution gadget) are rejected.
+    """
+
+    ALLOWED_CLASSES = frozenset([
+        ('builtins', 'bytearray'),
+        ('builtins', 'complex'),
+        ('builtins', 'frozenset'),
+        ('builtins', 'set'),
+        ('datetime', 'date'),
+        ('datetime', 'datetime'),
+        ('datetime', 'time'),
+        ('datetime', 'timedelta'),
+        ('datetime', 'timezone'),
+    ])
+
+    def find_class(self, module, name):
+        if (module, name) not in self.ALLOWED_CLASSES:
+            raise pickle.UnpicklingError(
+                "Refusing to load {}.{} from tmpl_files pickle".format(
+                    module,
+                    name
+                )
+            )
+
+        return super(SafeUnpickler, self).find_class(module, name)
+
+    @classmethod
+    def loads(cls, data):
+        return cls(io.BytesIO(data)).load()
+
+
+class SourceSnapshot:
+    """ Vault encrypted snapshot of parsed market/<market>/*/<env> sources.
+
+    Snapshot file is a JSON manifest line with source hashes followed by
+    vault encrypted pickle of parsed sources, loaded with SafeUnpickler.
+    Manifest lets stale snapshots be skipped without decrypting; the
+    decrypted payload carries the same hashes, so manifest tampering can not
+    substitute sources.
+    """
+
+    _loaded = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_path(root, market, env):
+        snapshot_dir = os.environ.get(
+            SNAPSHOT_DIR_ENV_VAR,
+            os.path.join(root, 'tmp', 'snapshots')
+        )
+
+        return os.path.join(
+            snapshot_dir,
+            '{}-{}.snapshot'.format(market, env)
+        )
+
+    @staticmethod
+    def _hash_file(path):
+        with open(path, 'rb') as stream:
+            return sha256(stream.read()).hexdigest()
+
+    @staticmethod
+    def get_sources(root, market, env):
+        """ Returns sorted List of source paths relative to market dir. """
+        market_dir = os.path.join(root, 'market', market)
+        sources = []
+
+        for kind in SNAPSHOT_KINDS:
+            env_dir = os.path.join(market_dir, kind, env)
+
+            for dir_path, _, file_names in os.walk(env_dir):
+                for file_name in file_names:
+                    path = os.path.join(dir_path, file_name)
+                    if SNAPSHOT_SOURCE_PATTERN.match(os.path.realpath(path)):
+                        sources.append(os.path.relpath(path, market_dir))
+
+        return sorted(sources)
+
+    @classmethod
+    def compile(cls, root, market, env, vault_pass=None):
+        """ Parses all market env sources in to snapshot; returns its path. """
+        root = os.path.realpath(root)
+        market_dir = os.path.join(root, 'market', market)
+        payload = {
+            'version': SNAPSHOT_VERSION,
+            'market': market,
+            'env': env,
+            'sources': {},
+        }
+
+        for rel_path in cls.get_sources(root, market, env):
+            path = os.path.join(market_dir, rel_path)
+            source = DictPath('{}:'.format(path), vault_pass)
+            # Preset cache key skips cache and snapshot probing, so sources
+            # are always read from disk.
+            source.cache_key = SOURCE_CACHE.get_key(path)
+            vault_pass = source.vault_pass
+            payload['sources'][rel_path] = {
+                'sha256': cls._hash_file(path),
+                'is_secret': source.is_encrypted(),
+                'data': source.get_full_dict(),
+            }
+
+        if not payload['sources']:
+            raise IOError(
+                "No sources found for market {} env {} in: {}".format(
+                    market,
+                    env,
+                    market_dir
+                )
+            )
+
+        manifest = dict(payload, sources={
+            rel_path: source['sha256']
+            for rel_path, source in payload['sources'].items()
+        })
+        vault = VaultLib([('default', VaultSecret(vault_pass))])
+        vaulttext = vault.encrypt(
+            pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+        )
+
+        path = cls.get_path(root, market, env)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                stream.write(json.dumps(manifest, sort_keys=True).encode())
+                stream.write(b'\n')
+                stream.write(vaulttext)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+        return path
+
+    @classmethod
+    def _load(cls, path, root, market, vault_pass):
+        with open(path, 'rb') as stream:
+            manifest = json.loads(stream.readline().decode())
+
+            if manifest.get('version') != SNAPSHOT_VERSION:
+                return None
+
+            market_dir = os.path.join(root, 'market', market)
+            signatures = {}
+
+            for rel_path, digest in manifest['sources'].items():
+                source_path = os.path.join(market_dir, rel_path)
+                try:
+                    signatures[rel_path] = SOURCE_CACHE.get_key(source_path)
+                    is_match = cls._hash_file(source_path) == digest
+                except (IOError, OSError):
+                    is_match = False
+
+                if not is_match:
+                    display.vvv(
+                        "tmpl_files snapshot {} is stale: {}".format(
+                            path,
+                            rel_path
+                        )
+                    )
+                    return None
+
+            payload = SafeUnpickler.loads(
+                VaultDecryptor.get(vault_pass).decrypt(stream.read())
+            )
+
+        if {
+            rel_path: source['sha256']
+            for rel_path, source in payload['sources'].items()
+        } != manifest['sources']:
+            return None
+
+        # Kept pickled like SOURCE_CACHE entries, so sources handed out are
+        # private copies.
+        return {
+            signatures[rel_path]: pickle.dumps(
+                (source['is_secret'], source['data']),
+                protocol=pickle.HIGHEST_PROTOCOL
+            )
+            for rel_path, source in payload['sources'].items()
+        }
+
+    @classmethod
+    def get_source(cls, cache_key, vault_pass):
+        """ Returns (is_secret, full_dict) Tuple from snapshot or None. """
+        match = SNAPSHOT_SOURCE_PATTERN.match(cache_key[0])
+
+        if not match:
+            return None
+
+        path = cls.get_path(
+            match.group('root'),
+            match.group('market'),
+            match.group('env')
+        )
+
+        try:
+            snapshot_key = SOURCE_CACHE.get_key(path)
+        except (IOError, OSError):
+            return None
+
+        with cls._lock:
+            loaded_key, sources = cls._loaded.get(path, (None, None))
+
+            if loaded_key != snapshot_key:
+                try:
+                    sources = cls._load(
+                        path,
+                        match.group('root'),
+                        match.group('market'),
+                        vault_pass
+                    )
+                except Exception as e:
+                    display.warning(
+                        "Ignoring tmpl_files snapshot {}: {!s}".format(path, e)
+                    )
+                    sources = None
+
+                cls._loaded[path] = (snapshot_key, sources)
+
+        # Sources are keyed by file signature, so a source changed after the
+        # snapshot was validated is loaded from disk.
+        data = (sources or {}).get(cache_key)
+
+        return None if data is None else pickle.loads(data)
+
+
+def _send_message(sock, data):
+    sock.sendall(MESSAGE_HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise EOFError("Connection closed by peer")
+
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return b''.join(chunks)
+
+
+def _recv_message(sock):
+    size, = MESSAGE_HEADER.unpack(_recv_exactly(sock, MESSAGE_HEADER.size))
+
+    return _recv_exactly(sock, size)
+
+
+class _SourceCacheHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(_recv_message(self.request).decode())
+            response = self.server.get_source(
+                request['path'],
+                base64.b64decode(request['vault_pass'])
+            )
+        except Exception as e:
+            response = pickle.dumps({'error': "{!s}".format(e)})
+
+        _send_message(self.request, response)
+
+
+class SourceCacheServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Unix socket server sharing parsed sources between Ansible runs.
+
+    Sources are keyed by (real path, file signature, password fingerprint)
+    and expire after TTL. Concurrent requests for one source wait for a
+    single read and decrypt. Socket is created user-only and connections
+    from other users are refused by peer credentials.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, ttl=CACHE_SERVER_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._remove_stale_socket(path)
+
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(
+                self,
+                path,
+                _SourceCacheHandler
+            )
+        finally:
+            os.umask(umask)
+
+    @staticmethod
+    def _remove_stale_socket(path):
+        try:
+            st = os.stat(path)
+        except (IOError, OSError):
+            return
+
+        if not stat.S_ISSOCK(st.st_mode):
+            raise IOError("Not a socket: {}".format(path))
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except (IOError, OSError):
+            os.unlink(path)
+            return
+        finally:
+            sock.close()
+
+        raise IOError("Cache server is already running on: {}".format(path))
+
+    def verify_request(self, request, client_address):
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+
+        _, uid, _ = struct.unpack('3i', request.getsockopt(
+            socket.SOL_SOCKET,
+            socket.SO_PEERCRED,
+            struct.calcsize('3i')
+        ))
+
+        if uid != os.getuid():
+            display.warning(
+                "tmpl_files cache server refused connection of uid {}".format(uid)
+            )
+            return False
+
+        return True
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+
+        try:
+            os.unlink(self.path)
+        except (IOError, OSError):
+            pass
+
+    def _expire(self, now):
+        with self._lock:
+            for key, (expires, _) in list(self._entries.items()):
+                if expires <= now:
+                    del self._entries[key]
+
+            for key, lock in list(self._locks.items()):
+                if key not in self._entries and not lock.locked():
+                    del self._locks[key]
+
+    def get_source(self, path, vault_pass):
+        """ Returns pickled response with (is_secret, full_dict) source. """
+        cache_key = SOURCE_CACHE.get_key(path)
+        key = (cache_key, sha256(vault_pass).digest())
+
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        with lock:
+            now = time.time()
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            source = DictPath('{}:'.format(cache_key[0]), vault_pass)
+            # Preset cache key skips cache, server and snapshot probing.
+            source.cache_key = cache_key
+            response = pickle.dumps(
+                {
+                    'key': cache_key,
+                    'source': (source.is_encrypted(), source._load_yaml_file()),
+                },
+                protocol=pickle.HIGHEST_PROTOCOL
+            )
+
+            with self._lock:
+                self._entries[key] = (now + self.ttl, response)
+
+        self._expire(now)
+
+        return response
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': sum(len(entry[1]) for entry in self._entries.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class SourceCacheClient:
+    """ Queries SourceCacheServer; any failure means a local load. """
+
+    @staticmethod
+    def get_source(cache_key, vault_pass):
+        """ Returns (is_secret, full_dict) Tuple from server or None. """
+        path = os.environ.get(CACHE_SOCKET_ENV_VAR)
+
+        if not path:
+            return None
+
+        try:
+            st = os.stat(path)
+
+            if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+                display.vvvv(
+                    "tmpl_files ignoring cache socket not owned by user: {}".format(
+                        path
+                    )
+                )
+                return None
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(CACHE_CLIENT_TIMEOUT)
+
+            try:
+                sock.connect(path)
+                _send_message(sock, json.dumps({
+                    'path': cache_key[0],
+                    'vault_pass': base64.b64encode(vault_pass).decode(),
+                }).encode())
+                response = SafeUnpickler.loads(_recv_message(sock))
+            finally:
+                sock.close()
+        except Exception as e:
+            display.vvvv(
+                "tmpl_files cache server {} unavailable: {!s}".format(path, e)
+            )
+            return None
+
+        if 'error' in response:
+            display.vvvv(
+                "tmpl_files cache server error: {!s}".format(response['error'])
+            )
+            return None
+
+        # Server stats the file itself; a file changed in between is loaded
+        # locally.
+        if tuple(response['key']) != tuple(cache_key):
+            return None
+
+        return response['source']
+
+
+class SubtreeFallback(Exception):
+    """ Dict path subtree can not be loaded alone; full load is required. """
+
+
+class _EventLoader(
+    yaml.composer.Composer,
+    yaml.constructor.FullConstructor,
+    yaml.resolver.Resolver,
+):
+    """ Composes and constructs a document from a list of parser events. """
+
+    def __init__(self, events):
+        self.events = events
+        self.event_index = 0
+        yaml.composer.Composer.__init__(self)
+        yaml.constructor.FullConstructor.__init__(self)
+        yaml.resolver.Resolver.__init__(self)
+
+    def check_event(self, *choices):
+        if self.event_index >= len(self.events):
+            return False
+
+        if not choices:
+            return True
+
+        return isinstance(self.events[self.event_index], choices)
+
+    def peek_event(self):
+        return self.events[self.event_index]
+
+    def get_event(self):
+        event = self.events[self.event_index]
+        self.event_index += 1
+        return event
+
+    def dispose(self):
+        pass
+
+
+class YamlSubtree:
+    """ Loads only the subtree under a dict path from a YAML document.
+
+    Parser events are streamed once; events of siblings outside the path are
+    skipped without composing nodes and only the selected subtree is built
+    in to Python objects. Anything the event walk can not prove equal to a
+    full load (aliases or merge keys on the path, aliases to anchors outside
+    the subtree, duplicate or non-string keys, missing keys) raises
+    SubtreeFallback.
+    """
+
+    STR_TAG = 'tag:yaml.org,2002:str'
+    MERGE_TAG = 'tag:yaml.org,2002:merge'
+    _resolver = yaml.resolver.Resolver()
+
+    @classmethod
+    def _get_key_tag(cls, event):
+        if event.tag not in (None, '!'):
+            return event.tag
+
+        return cls._resolver.resolve(
+            yaml.ScalarNode,
+            event.value,
+            event.implicit
+        )
+
+    @staticmethod
+    def _skip_node(events, event):
+        if not isinstance(event, yaml.CollectionStartEvent):
+            return
+
+        depth = 1
+        while depth:
+            event = next(events)
+            if isinstance(event, yaml.CollectionStartEvent):
+                depth += 1
+            elif isinstance(event, yaml.CollectionEndEvent):
+                depth -= 1
+
+    @staticmethod
+    def _take_node(events, event):
+        node_events = [event]
+
+        if not isinstance(event, yaml.CollectionStartEvent):
+            return node_events
+
+        depth = 1
+        while depth:
+            event = next(events)
+            node_events.append(event)
+            if isinstance(event, yaml.CollectionStartEvent):
+                depth += 1
+            elif isinstance(event, yaml.CollectionEndEvent):
+                depth -= 1
+
+        return node_events
+
+    @classmethod
+    def _select_mapping_value(cls, events, key):
+        selected = None
+
+        while True:
+            key_event = next(events)
+            if isinstance(key_event, yaml.MappingEndEvent):
+                break
+
+            if not isinstance(key_event, yaml.ScalarEvent):
+                raise SubtreeFallback("non scalar key on the path")
+
+            key_tag = cls._get_key_tag(key_event)
+            if key_tag == cls.MERGE_TAG:
+                raise SubtreeFallback("merge key on the path")
+
+            value_event = next(events)
+
+            if key_event.value != key:
+                cls._skip_node(events, value_event)
+                continue
+
+            if key_tag != cls.STR_TAG:
+                raise SubtreeFallback("non string key: {}".format(key))
+
+            if selected is not None:
+                raise SubtreeFallback("duplicate key: {}".format(key))
+
+            selected = cls._take_node(events, value_event)
+
+        if selected is None:
+            raise SubtreeFallback("key not found: {}".format(key))
+
+        return selected
+
+    @classmethod
+    def _select_sequence_item(cls, events, key):
+        try:
+            index = int(key)
+        except ValueError:
+            raise SubtreeFallback("index is not an Int: {}".format(key))
+
+        selected = None
+        i = 0
+
+        while True:
+            event = next(events)
+            if isinstance(event, yaml.SequenceEndEvent):
+                break
+
+            if i == index:
+                selected = cls._take_node(events, event)
+            else:
+                cls._skip_node(events, event)
+            i += 1
+
+        if selected is None:
+            raise SubtreeFallback("index out of range: {}".format(key))
+
+        return selected
+
+    @classmethod
+    def _select(cls, events, key):
+        event = next(events)
+
+        if isinstance(event, yaml.MappingStartEvent):
+            return cls._select_mapping_value(events, key)
+        elif isinstance(event, yaml.SequenceStartEvent):
+            return cls._select_sequence_item(events, key)
+
+        raise SubtreeFallback("no collection at: {}".format(key))
+
+    @classmethod
+    def load(cls, data, keys, loader=YAML_LOADER):
+        try:
+            events = yaml.parse(data, Loader=loader)
+
+            if not (
+                isinstance(next(events), yaml.StreamStartEvent)
+                and isinstance(next(events), yaml.DocumentStartEvent)
+            ):
+                raise SubtreeFallback("empty document")
+
+            node_events = cls._select(events, keys[0])
+
+            if not (
+                isinstance(next(events), yaml.DocumentEndEvent)
+                and isinstance(next(events), yaml.StreamEndEvent)
+            ):
+                raise SubtreeFallback("multiple documents")
+
+            for key in keys[1:]:
+                node_events = cls._select(iter(node_events), key)
+
+            return _EventLoader(
+                [yaml.StreamStartEvent(), yaml.DocumentStartEvent()]
+                + node_events
+                + [yaml.DocumentEndEvent(), yaml.StreamEndEvent()]
+            ).get_single_data()
+        except YAMLError as e:
+            # Undefined aliases (anchors outside the subtree) and syntax
+            # errors alike are left to the full load to handle or report.
+            raise SubtreeFallback(e)
+
 
 class DictPath:
     """ Transforms 'dir/dict_path.yml:dict.key' strings in to object. """
 
-    def __init__(self, opath, vault_pass=None):
+    def __init__(self, opath, vault_pass=None, subtree=False, timings=None):
+        self.timings = timings or Timings(enabled=False)
         self.vault_file_line = os.environ.get(
             'ANSIBLE_VAULT_FILE_LINE',
             VAULT_FILE_LINE
         )
         self.vault_pass = vault_pass or os.environ.get(VAULT_PASS_ENV_VAR)
         self.opath = opath
-        self.file_path, self.dict_path = self._get_file_and_dict_paths()
+
+        with self.timings.phase('resolve', self.opath):
+            self.file_path, self.dict_path = self._get_file_and_dict_paths()
+
+        self.subtree = subtree
+        self.cache_key = None
         self.is_secret = None
         self.full_dict = None
         self.dict = None
+        self.parse_time = None
+        self.data = None
 
     def __str__(self):
         return "{!s}".format(self.opath)
@@ -190,32 +1379,70 @@ class DictPath:
 
         return thing or {}
 
-    def _decrypt_vault_raw_stream(self, stream):
-        vault = VaultLib([('default', VaultSecret(self.vault_pass))])
-        return vault.decrypt(stream.read())
+    def _read_yaml_file(self):
+        if self.data is not None:
+            data, self.data = self.data, None
+            return data
 
-    def _load_yaml_file(self, default={}):
-        with open(self.file_path, 'rb') as stream:
-            try:
-                if self.is_encrypted():
-                    return yaml.load(
-                        self._decrypt_vault_raw_stream(stream),
-                        Loader=yaml.FullLoader
-                    )
+        is_encrypted = self.is_encrypted()
 
-                return yaml.load(stream, Loader=yaml.FullLoader)
+        with self.timings.phase('read', self.opath):
+            with open(self.file_path, 'rb') as stream:
+                data = stream.read()
 
-            except YAMLError as e:
-                raise TypeError(
-                    "Error parsing yaml file: {!s}".format(e)
-                )
+        self.timings.count('bytes_read', len(data), self.opath)
 
-    def _set_dict(self):
-        final_dict = self._deep_get(
-            self.get_full_dict(),
-            *self.dict_path.split('.')
+        if not is_encrypted:
+            return data
+
+        with self.timings.phase('decrypt', self.opath):
+            data = VaultDecryptor.get(self.vault_pass).decrypt(data)
+
+        self.timings.count('bytes_decrypted', len(data), self.opath)
+
+        return data
+
+    def _timed_parse(self, parse, data, name):
+        start = time.perf_counter()
+
+        try:
+            result = parse(data)
+        except YAMLError as e:
+            raise TypeError(
+                "Error parsing yaml file: {!s}".format(e)
+            )
+
+        self.parse_time = time.perf_counter() - start
+        self.timings.add('parse', self.parse_time, self.opath)
+        display.vvvv(
+            "tmpl_files parsed {} ({} bytes) in {:.2f}ms with {}".format(
+                self.file_path,
+                len(data),
+                self.parse_time * 1000,
+                name
+            )
+        )
+
+        return result
+
+    def _load_yaml_file(self, data=None):
+        if data is None:
+            data = self._read_yaml_file()
+
+        return self._timed_parse(
+            lambda d: yaml.load(d, Loader=YAML_LOADER),
+            data,
+            YAML_LOADER.__name__
+        )
+
+    def _load_yaml_subtree(self, data):
+        return self._timed_parse(
+            lambda d: YamlSubtree.load(d, self.dict_path.split('.')),
+            data,
+            "{} subtree".format(YAML_LOADER.__name__)
         )
 
+    def _check_dict(self, final_dict):
         if not isinstance(final_dict, dict):
             raise TypeError(
                 (
@@ -230,6 +1457,86 @@ class DictPath:
 
         return final_dict
 
+    def _set_dict(self):
+        full_dict = self.get_full_dict()
+
+        with self.timings.phase('deep_get', self.opath):
+            final_dict = self._deep_get(full_dict, *self.dict_path.split('.'))
+
+        return self._check_dict(final_dict)
+
+    def _set_subtree_dict(self):
+        # A whole document already in cache or snapshot is cheaper to walk
+        # than to re-parse, so subtree loading is only used on a miss.
+        self._probe_cache()
+
+        if self.full_dict is not None:
+            return self._set_dict()
+
+        real_path, signature = self.cache_key
+        subtree_key = ("{}:{}".format(real_path, self.dict_path), signature)
+        source = SOURCE_CACHE.get(subtree_key)
+
+        if source is None:
+            data = self._read_yaml_file()
+
+            try:
+                subtree = self._load_yaml_subtree(data)
+            except SubtreeFallback as e:
+                display.vvvv(
+                    "tmpl_files full load of {}: {!s}".format(self.opath, e)
+                )
+                self.full_dict = self._load_yaml_file(data)
+                SOURCE_CACHE.put(
+                    self.cache_key,
+                    (self.is_encrypted(), self.full_dict)
+                )
+                return self._set_dict()
+
+            source = (self.is_encrypted(), subtree)
+            SOURCE_CACHE.put(subtree_key, source)
+
+        self.is_secret, subtree = source
+
+        return self._check_dict(subtree or {})
+
+    def _probe_cache(self):
+        # Cache is probed once per object; a hit fills both the encryption
+        # flag and the parsed document without opening the file.
+        if self.cache_key is not None:
+            return
+
+        self.cache_key = SOURCE_CACHE.get_key(self.file_path)
+        source = SOURCE_CACHE.get(self.cache_key)
+
+        if source is None and os.environ.get(CACHE_SOCKET_ENV_VAR):
+            with self.timings.phase('cache_server', self.opath):
+                source = SourceCacheClient.get_source(
+                    self.cache_key,
+                    self.vault_pass
+                )
+
+            if source is not None:
+                SOURCE_CACHE.put(self.cache_key, source)
+
+        if source is None:
+            source = SourceSnapshot.get_source(self.cache_key, self.vault_pass)
+
+            if source is not None:
+                SOURCE_CACHE.put(self.cache_key, source)
+
+        if source is not None:
+            self.is_secret, self.full_dict = source
+
+    def preload(self):
+        """ Reads and decrypts a source not found in cache for later parse. """
+        self._probe_cache()
+
+        if self.full_dict is None and self.data is None:
+            self.data = self._read_yaml_file()
+
+        return self
+
     def get_file_path(self):
         return self.file_path
 
@@ -237,80 +1544,339 @@ class DictPath:
         return self.dict_path
 
     def is_encrypted(self):
+        self._probe_cache()
+
         if self.is_secret is None:
-            with open(self.file_path, 'rb') as stream:
-                first_line = stream.readline()
-                self.is_secret = first_line.startswith(self.vault_file_line)
+            with self.timings.phase('vault_detect', self.opath):
+                with open(self.file_path, 'rb') as stream:
+                    first_line = stream.readline()
+                    self.is_secret = first_line.startswith(
+                        self.vault_file_line
+                    )
 
         return self.is_secret
 
     def get_full_dict(self):
+        self._probe_cache()
+
         if self.full_dict is None:
             self.full_dict = self._load_yaml_file()
+            SOURCE_CACHE.put(
+                self.cache_key,
+                (self.is_encrypted(), self.full_dict)
+            )
 
         return self.full_dict
 
     def get_dict(self):
         if self.dict is None:
-            self.dict = self._set_dict()
+            if self.subtree:
+                self.dict = self._set_subtree_dict()
+            else:
+                self.dict = self._set_dict()
 
         return self.dict
 
 
+class Placeholder:
+    """ Single "{! name !}" or "{? name ?}" occurrence in a template. """
+
+    __slots__ = ('kind', 'name', 'text', 'leaf', 'is_whole', 'value')
+
+    def __init__(self, kind, name, text, leaf=None):
+        self.kind = kind
+        self.name = name
+        self.text = text
+        self.leaf = leaf
+        self.is_whole = False
+        self.value = None
+
+    def __repr__(self):
+        return "Placeholder: {!s}".format(self.text)
+
+    def is_resolved(self):
+        return self.value is not None
+
+
+class TmplLeaf:
+    """ String value or key in tree mode template containing placeholders. """
+
+    __slots__ = ('path', 'is_key', 'is_changed', 'pieces')
+
+    def __init__(self, path, is_key=False, is_changed=False):
+        self.path = path
+        self.is_key = is_key
+        self.is_changed = is_changed
+        self.pieces = []
+
+    def __repr__(self):
+        return "TmplLeaf: {!r}".format(self.path)
+
+
 class DictTmpl:
-    """ Template substitution in Dictionary """
+    """ Template substitution in Dictionary
+
+    Placeholders are indexed once at construction by kind and variable name,
+    so each apply() costs O(matching placeholders) and is_template() is a
+    counter check. The Dict is rendered lazily by get_dict().
+    """
+
+    def __init__(self, tmpl_dict, mode='json'):
+        if mode not in TMPL_MODES:
+            raise ValueError(
+                "Unknown templating mode: {!s}; expected one of: {}".format(
+                    mode,
+                    ', '.join(TMPL_MODES)
+                )
+            )
 
-    def __init__(self, tmpl_dict):
+        self.mode = mode
         self.dict = tmpl_dict
-        self.json = self.get_json(tmpl_dict)
+        self.json = None
+        self.index = {SECRET_KIND: {}, PUBLIC_KIND: {}}
+        self.unresolved = 0
+        self.is_changed = False
+
+        if self.mode == 'tree':
+            self.root = tmpl_dict
+            self.leaves = {}
+            self._compile_tree(tmpl_dict, ())
+        else:
+            self.json = self.get_json(tmpl_dict)
+            self.pieces = self._compile(self.json, JSON_PATTERN)
 
     def __str__(self):
-        return "{!s}".format(self.dict)
+        return "{!s}".format(self.get_dict())
 
     def __repr__(self):
-        return "DictTmpl: {!s}".format(self.dict)
+        return "DictTmpl: {!s}".format(self.get_dict())
+
+    def _compile(self, text, pattern, leaf=None):
+        """ Splits text in to literal strings and indexed placeholders. """
+        pieces = []
+        pos = 0
+
+        for match in pattern.finditer(text):
+            if match.start() > pos:
+                pieces.append(text[pos:match.start()])
+
+            placeholder = Placeholder(
+                match.group(1),
+                match.group(2).strip(),
+                match.group(0),
+                leaf
+            )
+            self.index[placeholder.kind].setdefault(
+                placeholder.name,
+                []
+            ).append(placeholder)
+            self.unresolved += 1
+            pieces.append(placeholder)
+            pos = match.end()
+
+        if pos < len(text):
+            pieces.append(text[pos:])
+
+        return pieces
+
+    def _compile_leaf(self, text, path, is_key=False, is_changed=False):
+        if '{!' not in text and '{?' not in text:
+            return
+
+        leaf = TmplLeaf(path, is_key, is_changed)
+        leaf.pieces = self._compile(text, TREE_PATTERN, leaf)
+
+        if len(leaf.pieces) == 1 and not is_key:
+            if isinstance(leaf.pieces[0], Placeholder):
+                leaf.pieces[0].is_whole = True
+
+        if is_changed or any(isinstance(p, Placeholder) for p in leaf.pieces):
+            self.leaves[(path, is_key)] = leaf
+
+    def _compile_tree(self, node, path, is_changed=False):
+        if isinstance(node, str):
+            self._compile_leaf(node, path, is_changed=is_changed)
+
+        elif isinstance(node, dict):
+            for key, value in node.items():
+                if isinstance(key, str):
+                    self._compile_leaf(key, path + (key,), is_key=True)
+                self._compile_tree(value, path + (key,))
+
+        elif isinstance(node, list):
+            for i, value in enumerate(node):
+                self._compile_tree(value, path + (i,))
+
+    def _resolve(self, placeholder, value):
+        if self.mode == 'tree':
+            leaf = placeholder.leaf
+            leaf.is_changed = True
+
+            # Whole value placeholder is replaced by the native object,
+            # embedded placeholders are interpolated in to the string.
+            # Placeholders found in substituted values are indexed too, so
+            # subsequent sources can resolve them.
+            if placeholder.is_whole:
+                placeholder.value = [value]
+                self._compile_tree(value, leaf.path, is_changed=True)
+            else:
+                placeholder.value = self._compile(
+                    self.get_str_substitution(value),
+                    TREE_PATTERN,
+                    leaf
+                )
+        else:
+            placeholder.value = self._compile(
+                self.get_substitution(placeholder.text, value),
+                JSON_PATTERN
+            )
+
+        self.unresolved -= 1
 
     def apply(self, vars_dict, is_secret=False):
         if not self.is_template():
-            return self.dict
-
-        parse_pat = re.escape('!') if is_secret else re.escape('?')
+            return
 
-        # Matches pattern: "{! var-name !}" or {! var-name !}
-        pattern = r'"?{' + parse_pat + r'[- \w]*' + parse_pat + r'}"?'
+        names = self.index[SECRET_KIND if is_secret else PUBLIC_KIND]
 
-        # Builds List of Tuple [('matched_pattern', 'replace_with'),...],
-        # excluding keys that are not in secret_dict.
-        replacements = [
-            (s, vars_dict[s.strip(' "{}' + parse_pat)])
-            for s in re.findall(pattern, self.json)
-            if s.strip(' "{}' + parse_pat) in vars_dict
+        # Keys that are not in vars_dict are left for subsequent sources.
+        # Matches are taken out of the index before resolving, so
+        # placeholders brought in by substituted values are left for
+        # subsequent sources as well.
+        matches = [
+            (names.pop(name), vars_dict[name])
+            for name in names.keys() & vars_dict.keys()
         ]
 
+        for placeholders, value in matches:
+            for placeholder in placeholders:
+                self._resolve(placeholder, value)
+
+        if matches:
+            self.is_changed = True
+
+    @classmethod
+    def _render(cls, pieces, out):
+        for piece in pieces:
+            if isinstance(piece, Placeholder):
+                if piece.is_resolved():
+                    cls._render(piece.value, out)
+                else:
+                    out.append(piece.text)
+            else:
+                out.append(piece)
+
+        return out
+
+    def _render_leaf(self, leaf):
+        if len(leaf.pieces) == 1 and isinstance(leaf.pieces[0], Placeholder):
+            placeholder = leaf.pieces[0]
+            if placeholder.is_whole and placeholder.is_resolved():
+                return placeholder.value[0]
+
+        return ''.join(self._render(leaf.pieces, []))
+
+    def _render_tree(self):
+        # Only containers on the paths to changed leaves are shallow copied,
+        # untouched subtrees are shared with the source object. Values are
+        # set parent first; keys are renamed last, deepest first, so the
+        # paths of other leaves stay valid.
+        changed = [leaf for leaf in self.leaves.values() if leaf.is_changed]
+        values = sorted(
+            (leaf for leaf in changed if not leaf.is_key),
+            key=lambda leaf: len(leaf.path)
+        )
+        keys = sorted(
+            (leaf for leaf in changed if leaf.is_key),
+            key=lambda leaf: len(leaf.path),
+            reverse=True
+        )
+        copies = {}
+        root = self.root
+
+        for leaf in values:
+            root = self._set_path(root, leaf.path, self._render_leaf(leaf), copies)
+
+        for leaf in keys:
+            root = self._set_path(root, leaf.path[:-1], None, copies, rename=(
+                leaf.path[-1],
+                self._render_leaf(leaf)
+            ))
+
+        return root
+
+    @staticmethod
+    def _set_path(root, path, value, copies, rename=None):
+        # Copies are tracked by identity, so objects shared between several
+        # paths (e.g. YAML aliases) get an own copy per path.
+        def copy(node):
+            if id(node) in copies:
+                return node
+
+            new_node = node.copy()
+            copies[id(new_node)] = new_node
+
+            return new_node
+
+        if not path and rename is None:
+            return value
+
+        root = copy(root)
+        node = root
+
+        for key in path[:-1] if rename is None else path:
+            node[key] = copy(node[key])
+            node = node[key]
+
+        if rename is None:
+            node[path[-1]] = value
+        else:
+            old_key, new_key = rename
+            items = list(node.items())
+            node.clear()
+            node.update(
+                (new_key if key == old_key else key, value)
+                for key, value in items
+            )
+
+        return root
+
+    @classmethod
+    def get_substitution(cls, placeholder, value):
+        """ Returns JSON text replacing matched placeholder with value. """
+        is_quoted = placeholder.startswith('"') and placeholder.endswith('"')
+
+        # Cast int to str if Int is substituted as part of str.
+        if isinstance(value, int) and not is_quoted:
+            value = str(value)
+
+        value_json = cls.get_json(value)
+
         # In multiline values (e.g. key: >, or key: |), value blob gets quoted
         # in (") and all internal quotes are escaped. If matched pattern is not
         # quoted, then substitution inside quoted string is assumed and
         # internal quotes must be stripped.
-        for fr, to in replacements:
-            # Cast int to str if Int is substituted as part of str.
-            if isinstance(to, int) and not (fr.startswith('"') and fr.endswith('"')):
-                to = str(to)
+        if not placeholder.startswith('"'):
+            value_json = value_json.lstrip('"')
+        if not placeholder.endswith('"'):
+            value_json = value_json.rstrip('"')
 
-            to_json = self.get_json(to)
+        return value_json
 
-            if not fr.startswith('"'):
-                to_json = to_json.lstrip('"')
-            if not fr.endswith('"'):
-                to_json = to_json.rstrip('"')
+    @staticmethod
+    def get_str_substitution(value):
+        """ Returns string form of value embedded in to a string. """
+        if isinstance(value, str):
+            return value
 
-            self.json = self.json.replace(fr, to_json)
+        # Cast int to str if Int is substituted as part of str.
+        if isinstance(value, int):
+            return str(value)
 
         try:
-            self.dict = json.loads(self.json)
+            return json.dumps(value)
         except Exception as e:
-            raise ValueError("Error parsing combined Dict: {!s}".format(e))
-
-        return self.dict
+            raise ValueError("Error parsing source Dict: {!s}".format(e))
 
     @staticmethod
     def get_json(dict_to_json):
@@ -320,61 +1886,362 @@ class DictTmpl:
             raise ValueError("Error parsing source Dict: {!s}".format(e))
 
     def get_dict(self):
+        if not self.is_changed:
+            return self.dict
+
+        if self.mode == 'tree':
+            self.dict = self._render_tree()
+        else:
+            self.json = ''.join(self._render(self.pieces, []))
+
+            try:
+                self.dict = json.loads(self.json)
+            except Exception as e:
+                raise ValueError("Error parsing combined Dict: {!s}".format(e))
+
+        self.is_changed = False
+
         return self.dict
 
     def is_template(self):
-        return any(p in self.json for p in ['{!', '{?'])
+        return self.unresolved > 0
+
+    @staticmethod
+    def _format_path(path):
+        return '.'.join("{!s}".format(key) for key in path)
+
+    @classmethod
+    def _find_unresolved(cls, node, path, found):
+        if isinstance(node, str):
+            for match in TREE_PATTERN.finditer(node):
+                found.add((cls._format_path(path), match.group(0)))
+
+        elif isinstance(node, dict):
+            for key, value in node.items():
+                if isinstance(key, str):
+                    cls._find_unresolved(key, path + (key,), found)
+                cls._find_unresolved(value, path + (key,), found)
+
+        elif isinstance(node, list):
+            for i, value in enumerate(node):
+                cls._find_unresolved(value, path + (i,), found)
+
+        return found
+
+    def get_unresolved(self):
+        """ Returns sorted List of (dict path, placeholder) Tuples left. """
+        if not self.is_template():
+            return []
+
+        # Tree mode placeholders know their leaf; JSON mode placeholders are
+        # only text, so the rendered Dict is walked for them.
+        if self.mode == 'tree':
+            found = set(
+                (self._format_path(placeholder.leaf.path), placeholder.text)
+                for names in self.index.values()
+                for placeholders in names.values()
+                for placeholder in placeholders
+            )
+        else:
+            found = self._find_unresolved(self.get_dict(), (), set())
+
+        return sorted(found)
+
+
+class VarsGraph:
+    """ Placeholder dependency graph over variables of all sources.
+
+    Every variable name is taken from the first source defining it. Values
+    containing placeholders depend on the variables they reference and are
+    resolved depth first, dependencies before dependents, so each value is
+    substituted once and memoized for every template using it.
+    """
+
+    def __init__(self, mode='json'):
+        self.mode = mode
+        self.vars = {SECRET_KIND: {}, PUBLIC_KIND: {}}
+        self.resolved = {SECRET_KIND: {}, PUBLIC_KIND: {}}
+
+    def __repr__(self):
+        return "VarsGraph: {!r}".format(self.vars)
+
+    def add(self, vars_dict, is_secret=False):
+        names = self.vars[SECRET_KIND if is_secret else PUBLIC_KIND]
+
+        for name, value in vars_dict.items():
+            names.setdefault(name, value)
+
+    @staticmethod
+    def _format_node(node):
+        kind, name = node
+        return "{{{0} {1} {0}}}".format(kind, name)
+
+    def _resolve(self, node, path):
+        kind, name = node
+
+        if name in self.resolved[kind]:
+            return self.resolved[kind][name]
+
+        if node in path:
+            cycle = path[path.index(node):] + [node]
+            raise ValueError(
+                "Placeholder dependency cycle: {}".format(
+                    ' -> '.join(self._format_node(n) for n in cycle)
+                )
+            )
+
+        # Value is wrapped, so a whole value placeholder keeps the type of
+        # the referenced variable the same way it does in templates.
+        tmpl = DictTmpl({'value': self.vars[kind][name]}, mode=self.mode)
+
+        if tmpl.is_template():
+            path.append(node)
+            self.apply(tmpl, path)
+            path.pop()
+
+        value = tmpl.get_dict()['value']
+        self.resolved[kind][name] = value
+
+        return value
+
+    def apply(self, tmpl, path=None):
+        """ Substitutes all placeholders of tmpl known to the graph. """
+        if path is None:
+            path = []
+
+        for kind in (SECRET_KIND, PUBLIC_KIND):
+            vars_dict = dict(
+                (name, self._resolve((kind, name), path))
+                for name in list(tmpl.index[kind])
+                if name in self.vars[kind]
+            )
+            if vars_dict:
+                tmpl.apply(vars_dict, kind == SECRET_KIND)
 
 
 class LookupModule(LookupBase):
     """Templating lookup plugin."""
 
+    @staticmethod
+    def _load_vars(dict_path, subtree=False, timings=None, preloaded=None):
+        if preloaded is not None:
+            tmpl_vars = preloaded.result()
+        else:
+            tmpl_vars = DictPath(dict_path, subtree=subtree, timings=timings)
+
+        return (tmpl_vars.is_encrypted(), tmpl_vars.get_dict())
+
+    @staticmethod
+    def _preload_source(dict_path, subtree=False, timings=None):
+        return DictPath(dict_path, subtree=subtree, timings=timings).preload()
+
+    def _get_vars(self, dict_path, subtree=False, timings=None, preloaded=None):
+        # Second argument can be a string like 'dir/filename.yml:obj.key'
+        # which points to vault encrypted file or a Dict object.
+        if isinstance(dict_path, str):
+            try:
+                return self._load_vars(dict_path, subtree, timings, preloaded)
+            except (TypeError, ValueError, IndexError) as e:
+                raise AnsibleError(e)
+            except IOError as e:
+                display.warning("{!s}".format(e))
+                return (False, None)
+
+        elif isinstance(dict_path, dict):
+            return (False, dict_path)
+
+        raise AnsibleError(
+            "Expects a String or Dict as second parameter: {!s}".format(dict_path)
+        )
+
+    @staticmethod
+    def _get_parallel_workers(parallel, n_sources):
+        if parallel is True:
+            parallel = PARALLEL_MAX_WORKERS
+
+        try:
+            workers = int(parallel)
+        except (TypeError, ValueError):
+            raise AnsibleError(
+                "The parallel option must be a Bool or an Int: {!r}".format(
+                    parallel
+                )
+            )
+
+        return min(workers, n_sources)
+
+    def _preload_vars(self, var_paths_dicts, parallel, subtree, timings):
+        # Decryption and key derivation release the GIL, so vault sources
+        # are read and decrypted concurrently. YAML parsing holds the GIL and
+        # is left to the templating loop, which consumes results and errors
+        # in source order.
+        paths = []
+        for dict_path in var_paths_dicts:
+            if isinstance(dict_path, str) and dict_path not in paths:
+                paths.append(dict_path)
+
+        workers = self._get_parallel_workers(parallel, len(paths))
+
+        if workers < 2:
+            return {}
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+        try:
+            return dict(
+                (
+                    dict_path,
+                    executor.submit(
+                        self._preload_source,
+                        dict_path,
+                        subtree,
+                        timings
+                    )
+                )
+                for dict_path in paths
+            )
+        finally:
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def _is_ignored(path, ignore):
+        return any(path == p or path.startswith(p + '.') for p in ignore)
+
+    def _check_resolved(self, template_paths, tmpls, ignore=()):
+        errors = []
+
+        for template_path, tmpl in zip(template_paths, tmpls):
+            for path, placeholder in tmpl.get_unresolved():
+                if self._is_ignored(path, ignore):
+                    continue
+                errors.append("{} at {}".format(
+                    placeholder,
+                    '.'.join(p for p in (template_path, path) if p)
+                ))
+
+        if errors:
+            raise AnsibleError(
+                "Unresolved template placeholders: {}".format('; '.join(errors))
+            )
+
     def run(self, terms, variables=None, **kwargs):
 
-        template_path = terms[0]
+        template_paths = terms[0]
         var_paths_dicts = terms[1:]
+        mode = kwargs.get('mode', 'json')
+        subtree = kwargs.get('subtree', False)
+        parallel = kwargs.get('parallel', False)
+        overlay = kwargs.get('overlay')
+        overlay_conf = kwargs.get('overlay_conf', {})
+        strict = kwargs.get('strict', False)
+        strict_ignore = kwargs.get('strict_ignore', [])
+        chained = kwargs.get('chained', False)
 
-        # First argument is always a string like 'dir/filename.yml:obj.key'
         try:
-            tmpl_path = DictPath(template_path)
-            tmpl = DictTmpl(tmpl_path.get_dict())
-        except (TypeError, IOError, ValueError, IndexError) as e:
+            timings = Timings.from_env()
+        except ValueError as e:
             raise AnsibleError(e)
 
-        for dict_path in var_paths_dicts:
-            # Second argument can be a string like 'dir/filename.yml:obj.key'
-            # which points to vault encrypted file or a Dict object.
-            if isinstance(dict_path, str):
-                try:
-                    tmpl_vars = DictPath(dict_path)
-                except (TypeError, ValueError, IndexError) as e:
-                    raise AnsibleError(e)
-                except IOError as e:
-                    display.warning(e)
-                    continue
+        # First argument is a string like 'dir/filename.yml:obj.key' or a
+        # List of them rendered as a batch against the same sources.
+        if not isinstance(template_paths, list):
+            template_paths = [template_paths]
+
+        tmpls = []
+
+        for template_path in template_paths:
+            try:
+                tmpl_dict = DictPath(
+                    template_path,
+                    subtree=subtree,
+                    timings=timings
+                ).get_dict()
+
+                with timings.phase('compile', template_path):
+                    tmpl = DictTmpl(tmpl_dict, mode=mode)
+            except (TypeError, IOError, ValueError, IndexError) as e:
+                raise AnsibleError(e)
 
-                is_vars_secret = tmpl_vars.is_encrypted()
-                vars_dict = tmpl_vars.get_dict()
+            timings.count('placeholders', tmpl.unresolved, template_path)
+            tmpls.append(tmpl)
+
+        # Every source is loaded once and applied to all templates still
+        # having placeholders; sources after the last one needed are skipped.
+        pending = [tmpl for tmpl in tmpls if tmpl.is_template()]
+        preloaded = {}
+        graph = VarsGraph(mode=mode) if chained else None
+
+        if parallel and pending:
+            preloaded = self._preload_vars(
+                var_paths_dicts,
+                parallel,
+                subtree,
+                timings
+            )
 
-            elif isinstance(dict_path, dict):
-                is_vars_secret = False
-                vars_dict = dict_path
+        for i, dict_path in enumerate(var_paths_dicts):
+            if not pending:
+                break
 
-            else:
-                raise AnsibleError(
-                    "Expects a String or Dict as second parameter: {!s}".format(dict_path)
-                )
+            is_vars_secret, vars_dict = self._get_vars(
+                dict_path,
+                subtree,
+                timings,
+                preloaded.get(dict_path) if isinstance(dict_path, str) else None
+            )
+
+            if vars_dict is None:
+                continue
 
             if not vars_dict:
                 display.warning("Imported object is empty: {!r}".format(dict_path))
                 continue
 
+            if graph is not None:
+                graph.add(vars_dict, is_vars_secret)
+                continue
+
+            source = dict_path if isinstance(dict_path, str) else "{}".format(i + 1)
+
             try:
-                tmpl.apply(vars_dict, is_vars_secret)
+                for tmpl in pending:
+                    with timings.phase('apply', source):
+                        tmpl.apply(vars_dict, is_vars_secret)
             except ValueError as e:
                 raise AnsibleError(e)
 
-            if not tmpl.is_template():
-                break
+            pending = [tmpl for tmpl in pending if tmpl.is_template()]
+
+        if graph is not None:
+            try:
+                for tmpl in pending:
+                    with timings.phase('resolve_graph'):
+                        graph.apply(tmpl)
+            except ValueError as e:
+                raise AnsibleError(e)
+
+        display.vvvv("tmpl_files source cache: {!r}".format(SOURCE_CACHE.stats()))
+
+        try:
+            with timings.phase('loads'):
+                result = [tmpl.get_dict() for tmpl in tmpls]
+
+            if strict:
+                self._check_resolved(template_paths, tmpls, strict_ignore)
+
+            if overlay is not None:
+                with timings.phase('compose'):
+                    result = [
+                        DictCompose.compose(tmpl_dict, overlay, overlay_conf)
+                        for tmpl_dict in result
+                    ]
+        except ValueError as e:
+            raise AnsibleError(e)
+
+        timings.count(
+            'placeholders_unresolved',
+            sum(tmpl.unresolved for tmpl in tmpls)
+        )
+        timings.report(templates=template_paths, mode=mode)
 
-        return [tmpl.get_dict()]
+        return result
@@ -0,0 +1,34 @@
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+)
+
+__metaclass__ = type
+
+import os
+import sys
+import importlib.util
+
+# Plugins and utilities load this file by path and get shared modules from
+# load(), so the module naming below is the only place it is defined.
+
+SHARED_DIR = os.path.dirname(os.path.realpath(__file__))
+MODULE_NAME_PREFIX = 'tmpl_files_shared_'
+
+
+def load(name):
+    """ Returns plugins/shared/<name>.py module, loaded once per process. """
+    module_name = MODULE_NAME_PREFIX + name
+    module = sys.modules.get(module_name)
+
+    if module is None:
+        spec = importlib.util.spec_from_file_location(
+            module_name,
+            os.path.join(SHARED_DIR, '{}.py'.format(name))
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[module_name] = module
+
+    return module
@@ -0,0 +1,128 @@
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+)
+
+__metaclass__ = type
+
+# Loaded by both tmpl_files lookup and dict_merge filter, so it must not
+# import Ansible or the plugins themselves.
+
+
+class DictCompose:
+    """ Applies config overlays on top of a rendered template Dict.
+
+    Overlay item is a dotted path String, a Dict of dotted paths to values
+    or a List of them. Items are inflated in to nested Dict skeletons and
+    skeleton leaves without a value are filled from the overlay config,
+    falling back to the template. Filled skeletons are merged in item order
+    the way Ansible combine(recursive=True) merges them: Dicts are merged
+    and any other value, List included, replaces. A merge copies only the
+    Dicts on changed paths and shares everything else with its inputs.
+    """
+
+    _missing = object()
+
+    @classmethod
+    def _get(cls, o, key):
+        if isinstance(o, dict):
+            return o.get(key, cls._missing)
+
+        return cls._missing
+
+    @classmethod
+    def merge(cls, x, y):
+        """ Returns Dict y recursively merged on to Dict x. """
+        if not x:
+            return y
+
+        result = None
+
+        for key, y_value in y.items():
+            x_value = x.get(key, cls._missing)
+
+            if isinstance(x_value, dict) and isinstance(y_value, dict):
+                value = cls.merge(x_value, y_value)
+            else:
+                value = y_value
+
+            if value is x_value:
+                continue
+
+            if result is None:
+                result = dict(x)
+
+            result[key] = value
+
+        return x if result is None else result
+
+    @classmethod
+    def inflate(cls, item, value=None):
+        """ Returns nested Dict skeleton of dotted path overlay item. """
+        if isinstance(item, str):
+            for key in reversed(item.split('.')):
+                value = {key: value}
+
+            return value
+
+        skeleton = {}
+
+        if isinstance(item, dict):
+            for path, path_value in item.items():
+                skeleton = cls.merge(skeleton, cls.inflate(path, path_value))
+        elif isinstance(item, list):
+            for path in item:
+                skeleton = cls.merge(skeleton, cls.inflate(path))
+        else:
+            raise ValueError(
+                "Overlay item must be a String, Dict or List: {!r}".format(item)
+            )
+
+        return skeleton
+
+    @classmethod
+    def fill(cls, skeleton, template, overlay):
+        """ Fills empty skeleton leaves from overlay, else from template.
+
+        Leaves found in neither are dropped.
+        """
+        result = {}
+
+        for key, value in skeleton.items():
+            overlay_value = cls._get(overlay, key)
+            template_value = cls._get(template, key)
+
+            if isinstance(value, dict) and value:
+                value = cls.fill(value, template_value, overlay_value)
+                if not value:
+                    continue
+            elif value is None:
+                if overlay_value is not cls._missing:
+                    value = overlay_value
+                elif template_value is not cls._missing:
+                    value = template_value
+                else:
+                    continue
+
+            result[key] = value
+
+        return result
+
+    @classmethod
+    def compose(cls, template, overlays, overlay_conf):
+        """ Returns template with all overlay items applied in order. """
+        if not isinstance(overlays, list):
+            raise ValueError(
+                "Overlay must be a List: {!r}".format(overlays)
+            )
+
+        result = template
+
+        for item in overlays:
+            result = cls.merge(
+                result,
+                cls.fill(cls.inflate(item), template, overlay_conf)
+            )
+
+        return result
@@ -0,0 +1,210 @@
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+)
+
+__metaclass__ = type
+
+import os
+import re
+import json
+import tempfile
+import threading
+import time
+
+# Used by tmpl_files lookup and by utilities outside Ansible, so it must not
+# import Ansible or the plugins themselves.
+
+VAULT_FILE_LINE = '$ANSIBLE_VAULT;'
+MARKET_ROOT = os.path.realpath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..')
+)
+MARKET_INDEX_VERSION = 1
+MARKET_INDEX_FILE = os.path.join('tmp', 'market-index.json')
+# Seconds an in-process index is used without checking directory mtimes.
+MARKET_INDEX_CHECK_INTERVAL = 1
+SOURCE_KINDS = ('config', 'secret', 'template')
+# Matches path: '<root>/market/<market>/<kind>/<env>/<file>.yml'
+SOURCE_PATTERN = re.compile(
+    r'^(?P<root>.*)/market/(?P<market>[^/]+)/'
+    r'(?P<kind>' + '|'.join(SOURCE_KINDS) + r')/(?P<env>[^/]+)/.+\.ya?ml$'
+)
+
+
+def _no_log(msg):
+    pass
+
+
+class MarketIndex:
+    """ Index of market/<market>/<kind>/<env>/<service>.yml source files.
+
+    Market tree is scanned once and persisted; the index stays valid while
+    mtimes of all market directories are unchanged, i.e. no source was
+    added, removed or renamed. Entries record kind, vault encryption flag,
+    mtime and size, so an entry is trusted for a file only while its
+    mtime and size match.
+
+    Validation stats every market directory, since adding a source changes
+    just its own directory mtime, so it is meant for enumerating markets
+    (infra-vars find-ip). tmpl_files resolves single paths by probing the
+    file itself, which is cheaper than loading and validating the index in
+    every forked Ansible worker.
+    """
+
+    _indexes = {}
+    _lock = threading.Lock()
+
+    def __init__(self, root, dirs, files):
+        self.root = root
+        self.dirs = dirs
+        self.files = files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __repr__(self):
+        return "MarketIndex: {} ({} files)".format(self.root, len(self.files))
+
+    @staticmethod
+    def _is_vault_file(path):
+        with open(path, 'rb') as stream:
+            return stream.readline().startswith(VAULT_FILE_LINE.encode())
+
+    @classmethod
+    def scan(cls, root):
+        root = os.path.realpath(root)
+        market_dir = os.path.join(root, 'market')
+        dirs = {}
+        files = {}
+
+        for dir_path, _, file_names in os.walk(market_dir):
+            rel_dir = os.path.relpath(dir_path, root)
+            dirs[rel_dir] = os.stat(dir_path).st_mtime_ns
+
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                match = SOURCE_PATTERN.match(path)
+
+                if not match:
+                    continue
+
+                st = os.stat(path)
+                env_dir = os.path.join(
+                    market_dir,
+                    match.group('market'),
+                    match.group('kind'),
+                    match.group('env')
+                )
+                files[os.path.relpath(path, root)] = {
+                    'market': match.group('market'),
+                    'kind': match.group('kind'),
+                    'env': match.group('env'),
+                    'service': os.path.splitext(
+                        os.path.relpath(path, env_dir)
+                    )[0],
+                    'is_secret': cls._is_vault_file(path),
+                    'mtime_ns': st.st_mtime_ns,
+                    'size': st.st_size,
+                }
+
+        return cls(root, dirs, files)
+
+    def is_valid(self):
+        for rel_dir, mtime_ns in self.dirs.items():
+            try:
+                if os.stat(os.path.join(self.root, rel_dir)).st_mtime_ns != mtime_ns:
+                    return False
+            except (IOError, OSError):
+                return False
+
+        return True
+
+    @classmethod
+    def _read(cls, root):
+        try:
+            with open(os.path.join(root, MARKET_INDEX_FILE)) as stream:
+                data = json.load(stream)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if data.get('version') != MARKET_INDEX_VERSION or data.get('root') != root:
+            return None
+
+        return cls(root, data['dirs'], data['files'])
+
+    def save(self, log=_no_log):
+        path = os.path.join(self.root, MARKET_INDEX_FILE)
+
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        except (IOError, OSError) as e:
+            log("tmpl_files market index is not saved: {!s}".format(e))
+            return
+
+        try:
+            with os.fdopen(fd, 'w') as stream:
+                json.dump({
+                    'version': MARKET_INDEX_VERSION,
+                    'root': self.root,
+                    'dirs': self.dirs,
+                    'files': self.files,
+                }, stream, sort_keys=True)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def get(cls, root=MARKET_ROOT, log=_no_log):
+        """ Returns valid index of root, rescanning if needed, or None.
+
+        Rescans and save failures are reported through log callable.
+        """
+        root = os.path.realpath(root)
+
+        if not os.path.isdir(os.path.join(root, 'market')):
+            return None
+
+        with cls._lock:
+            checked, index = cls._indexes.get(root, (0, None))
+            now = time.time()
+
+            if index is not None and now - checked < MARKET_INDEX_CHECK_INTERVAL:
+                return index
+
+            if index is None or not index.is_valid():
+                index = cls._read(root)
+
+            if index is None or not index.is_valid():
+                index = cls.scan(root)
+                index.save(log)
+                log("tmpl_files scanned {!r}".format(index))
+
+            cls._indexes[root] = (time.time(), index)
+
+        return index
+
+    def get_entry(self, path):
+        """ Returns index entry of absolute source path or None. """
+        rel_path = os.path.relpath(os.path.normpath(path), self.root)
+
+        return self.files.get(rel_path)
+
+    def find(self, market=None, kind=None, env=None, service=None):
+        """ Returns sorted List of (absolute path, entry) Tuples matching. """
+        query = {
+            'market': market,
+            'kind': kind,
+            'env': env,
+            'service': service,
+        }
+
+        return sorted(
+            (os.path.join(self.root, rel_path), entry)
+            for rel_path, entry in self.files.items()
+            if all(
+                value is None or entry[key] == value
+                for key, value in query.items()
+            )
+        )